@@ -1,219 +1,435 @@
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import os
+import io
+import json
+import re
+import threading
+import time
+from collections import deque
+from itertools import islice
 
 # -----------------------
 # 常量配置
 # -----------------------
 TASKS_FILE = "origin/merge_jian_fan_freq_multi_0.1_20241231_anno.csv"       # 原始数据，只读，不回写
 PROGRESS_FILE = "result/multi_0.1_progress.csv"  # 标注进度写入这里
+SIDEBAR_LIMIT = 500  # 侧边栏最多展示的已标注条数
+CSV_DTYPES = {"原形": "string", "校对前": "string", "校对后": "string", "候选项": "string"}
+PROGRESS_JOURNAL = "result/multi_0.1_progress.jsonl"  # 每次修改追加一行，暂存时合并回 progress.csv
+JOURNAL_COMPACT_BYTES = 1 << 20  # 日志超过该大小时自动合并
+WRITE_BUFFER_BYTES = 1 << 20  # 合并写 progress.csv 时的缓冲区大小
+READ_BLOCK_BYTES = 4 << 20  # 分块读取 CSV 时每块的大小
+LOAD_WAIT_SECONDS = 1.0  # 首次加载超过该时长才显示进度条
+CATEGORY_MAX_UNIQUE_RATIO = 0.5  # 「候选项」去重后占比低于该值时改用 category 存储
+
+# 候选项形如 "(一個, 16839) (一箇, 11380)"
+_CANDIDATE_PATTERN = re.compile(r"\(\s*([^,()]+?)\s*,\s*([^)]+?)\s*\)")
 
 # -----------------------
 # 辅助函数
 # -----------------------
-def load_tasks():
+def _read_csv(path, progress):
+    """
+    以 READ_BLOCK_BYTES 为单位分块读取 CSV，每读完一块就更新 progress 中的
+    loaded_rows / loaded_fraction，供页面显示加载进度。
+    各列均按字符串读取，且不做缺失值识别：空单元格为 ""，"N/A" 保持原样。
+    """
+    total_bytes = max(os.path.getsize(path), 1)
+    with open(path, "rb") as f:
+        reader = pacsv.open_csv(
+            f,
+            read_options=pacsv.ReadOptions(block_size=READ_BLOCK_BYTES),
+            convert_options=pacsv.ConvertOptions(
+                column_types={col: pa.string() for col in CSV_DTYPES},
+                null_values=[],
+                strings_can_be_null=False,
+            ),
+        )
+        batches = []
+        for batch in reader:
+            batches.append(batch)
+            progress["loaded_rows"] += batch.num_rows
+            progress["loaded_fraction"] = min(f.tell() / total_bytes, 1.0)
+        table = pa.Table.from_batches(batches, schema=reader.schema)
+    return table.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+
+def load_tasks(progress):
     """
     读取 tasks.csv（只读），要求包含列: [原形, 校对前, 校对后, 候选项]
     """
     if not os.path.exists(TASKS_FILE):
-        st.error(f"未找到原始任务文件：{TASKS_FILE}")
-        st.stop()
-    df = pd.read_csv(TASKS_FILE)
+        raise FileNotFoundError(f"未找到原始任务文件：{TASKS_FILE}")
+    df = _read_csv(TASKS_FILE, progress)
     for col in ["原形", "校对前", "校对后", "候选项"]:
         if col not in df.columns:
-            st.error(f"{TASKS_FILE} 缺少必要列：{col}")
-            st.stop()
+            raise ValueError(f"{TASKS_FILE} 缺少必要列：{col}")
     return df
 
-def load_progress():
+def load_progress(progress):
     """
     如果 progress.csv 存在，则读取并返回；
     否则用 tasks.csv 的结构创建一份 progress.csv，并将「校对后」置空。
+    仅在后台加载共享状态时调用（见 get_state），之后以共享状态为准。
     """
     if os.path.exists(PROGRESS_FILE):
-        df_progress = pd.read_csv(PROGRESS_FILE)
+        df_progress = _read_csv(PROGRESS_FILE, progress)
         # 若缺少必需列，则补齐
         for col in ["原形", "校对前", "校对后", "候选项"]:
             if col not in df_progress.columns:
                 df_progress[col] = ""
-        df_progress["校对后"] = df_progress["校对后"].fillna("").astype(str)
+        replay_journal(df_progress)
         return df_progress
     else:
-        df_tasks = load_tasks()
+        df_tasks = load_tasks(progress)
         # 复制后将“校对后”清空，以防万一
         df_tasks["校对后"] = ""
-        df_tasks.to_csv(PROGRESS_FILE, index=False, encoding="utf-8")
+        save_progress(df_tasks)
         return df_tasks
 
 def save_progress(df):
     """
-    将标注进度写回 progress.csv
+    将标注进度写回 progress.csv，并清空已合并的日志。
+    先写临时文件再原子替换，避免其他会话读到写了一半的文件。
+    """
+    tmp_path = PROGRESS_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8", buffering=WRITE_BUFFER_BYTES, newline="") as f:
+        df.to_csv(f, index=False)
+    os.replace(tmp_path, PROGRESS_FILE)
+    if os.path.exists(PROGRESS_JOURNAL):
+        os.remove(PROGRESS_JOURNAL)
+
+def close_journal(state):
+    """
+    关闭共享状态中持有的 progress.jsonl 句柄（如有）
+    """
+    f = state["journal_file"]
+    state["journal_file"] = None
+    if f is not None:
+        f.close()
+
+def append_journal(state, idx, corrected_str):
+    """
+    将单条修改追加到 progress.jsonl，避免每次点击都重写整个 progress.csv。
+    句柄只打开一次并由所有会话共享；行缓冲保证每次修改只产生一次 write，
+    且进程重启后能立即回放到这条记录。返回当前日志大小。
     """
-    df.to_csv(PROGRESS_FILE, index=False, encoding="utf-8")
+    f = state["journal_file"]
+    if f is None:
+        f = open(PROGRESS_JOURNAL, "a", encoding="utf-8", buffering=1)
+        state["journal_file"] = f
+    f.write(json.dumps({"idx": int(idx), "校对后": corrected_str}, ensure_ascii=False) + "\n")
+    return f.tell()
+
+def replay_journal(df):
+    """
+    按顺序回放 progress.jsonl 中的修改，还原「校对后」列。
+    意外中断导致的残缺行直接跳过。
+    """
+    if not os.path.exists(PROGRESS_JOURNAL):
+        return
+    with open(PROGRESS_JOURNAL, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["idx"] in df.index:
+                df.at[record["idx"], "校对后"] = record["校对后"]
 
 def parse_candidates(candidate_str):
     """
-    将候选项字符串解析为 [(candidate, freq), ...]
-    例如 'example1_1:10;example1_2:5'
+    将候选项字符串解析为 [(candidate, freq), ...]，freq 为 int，按频次从高到低排序
+    例如 '(一個, 16839) (一箇, 11380)'
+    同一候选项重复出现时只保留第一次的频次，保证每个候选项只对应一个勾选框。
     """
-    if not candidate_str or pd.isna(candidate_str):
+    if not candidate_str:
         return []
-    candidate_str = candidate_str.replace(", ", ",")
-    parts = candidate_str.split(" ")
-    result = []
-    for p in parts:
-        p = p.strip()[1:-1]
-        if "," in p:
-            c, f = p.split(",", 1)
-            c, f = c.strip(), f.strip()
-            result.append((c, f))
-    return result
+    result = {}
+    for c, f in _CANDIDATE_PATTERN.findall(candidate_str):
+        result.setdefault(c, int(f))
+    return sorted(result.items(), key=lambda x: -x[1])
+
+def get_candidates(state, idx):
+    """
+    返回第 idx 行解析并排序好的候选项；首次访问时解析，结果存入共享状态供所有会话复用
+    """
+    parsed = state["parsed_candidates"]
+    if parsed[idx] is None:
+        parsed[idx] = parse_candidates(state["cands_raw"][idx])
+    return parsed[idx]
 
 def load_current_selection():
     """
-    根据 current_index，从 st.session_state['df_progress'] 中取出该行的「校对后」，
-    用分号分隔还原为列表，赋给 st.session_state["selected_list"]。
+    根据 current_index，从共享状态的 corrected 中取出该行的「校对后」，
+    用空格分隔还原为已选列表，赋给 st.session_state["selected"]。
     如果「校对后」为空，则默认选中「校对前」。
+    已为同一行构建过且未失效时直接返回（见 save_current_selection）。
     """
-    df_progress = st.session_state["df_progress"]
+    state = get_state()
     idx = st.session_state["current_index"]
-    row = df_progress.loc[idx]
-    corrected_str = row["校对后"] if not pd.isna(row["校对后"]) else ""
+    if st.session_state.get("selected_for_idx") == idx and "selected" in st.session_state:
+        return
+    corrected_str = state["corrected"].get(idx, "")
     if corrected_str:
         selected_list = [w.strip() for w in corrected_str.split(" ") if w.strip()]
     else:
-        selected_list = row["校对前"].strip().split(" ")
-    st.session_state["selected_list"] = selected_list
+        selected_list = state["pre"][idx].strip().split(" ")
+    # 以 dict 作为有序集合：成员判断和删除均为 O(1)，同时保留选择顺序
+    st.session_state["selected"] = dict.fromkeys(selected_list)
+    st.session_state["selected_str"] = " ".join(st.session_state["selected"])
+    st.session_state["selected_for_idx"] = idx
 
-def save_current_selection():
+def toggle_candidate(c):
     """
-    将 st.session_state["selected_list"] 写回「校对后」列，然后写入 progress.csv。
+    候选项勾选框的回调：切换 c 的选中状态，并更新缓存的「校对后」字符串
     """
-    df_progress = st.session_state["df_progress"]
+    selected = st.session_state["selected"]
+    if c in selected:
+        del selected[c]
+    else:
+        selected[c] = None
+    st.session_state["selected_str"] = " ".join(selected)
+
+def sync_corrected_column(df_progress, corrected):
+    """
+    运行期间「校对后」保存在共享状态的 corrected（{行号: 校对后}）中，
+    df_progress 中的该列不再随标注更新；合并写盘或下载前调用本函数将其写回。
+    """
+    df_progress["校对后"] = df_progress.index.map(corrected).fillna("")
+    return df_progress
+
+def _load_state(state):
+    """
+    后台线程：分块读取进度数据并填充共享状态，完成（或出错）后设置 ready。
+    """
+    try:
+        df_progress = load_progress(state)
+        # 候选项重复较多时按 category 存储，相同字符串只保留一份；
+        # 几乎不重复时 category 反而更占内存，保持原样
+        if df_progress["候选项"].nunique() < len(df_progress) * CATEGORY_MAX_UNIQUE_RATIO:
+            df_progress["候选项"] = df_progress["候选项"].astype("category")
+        corrected = {i: v for i, v in df_progress["校对后"].items() if v}
+        with state["lock"]:
+            state["df_progress"] = df_progress
+            state["corrected"] = corrected
+            state["annotated_idx"] = deque(corrected)
+            state["parsed_candidates"] = [None] * len(df_progress)
+            # 只读列另存为 Python 列表，热路径按行号直接取值，不构造 Series
+            state["origins"] = df_progress["原形"].tolist()
+            state["pre"] = df_progress["校对前"].tolist()
+            state["cands_raw"] = df_progress["候选项"].tolist()
+    except Exception as e:
+        state["load_error"] = e
+    finally:
+        state["ready"].set()
+
+@st.cache_resource(show_spinner=False)
+def get_state():
+    """
+    所有会话共享的标注进度：DataFrame 只加载一份，多开标签页不会重复占用内存。
+    数据在后台线程中加载，ready 置位前只有 loaded_rows / loaded_fraction 可用。
+    修改 corrected / annotated_idx / journal_file 等可变成员时需持有 lock。
+    """
+    state = {
+        "ready": threading.Event(),
+        "load_error": None,
+        "loaded_rows": 0,
+        "loaded_fraction": 0.0,
+        "lock": threading.Lock(),
+        "edit_version": 0,
+        "export_cache": {},
+        "journal_file": None,
+    }
+    threading.Thread(target=_load_state, args=(state,), daemon=True).start()
+    return state
+
+def progress_csv_exporter():
+    """
+    返回供下载按钮使用的无参函数：只有用户点击「下载」时才序列化完整进度，
+    结果按 edit_version 缓存，未修改时直接复用。
+    由 pyarrow 直接写出 UTF-8 字节，不经过 Python 字符串。
+    下载回调在独立线程中执行，因此提前取出共享状态。
+    """
+    state = get_state()
+
+    def export():
+        with state["lock"]:
+            cache = state["export_cache"]
+            if cache.get("version") != state["edit_version"]:
+                df_progress = sync_corrected_column(state["df_progress"], state["corrected"])
+                buf = io.BytesIO()
+                pacsv.write_csv(pa.Table.from_pandas(df_progress, preserve_index=False), buf)
+                cache["data"] = buf.getvalue()
+                cache["version"] = state["edit_version"]
+            return cache["data"]
+
+    return export
+
+def save_current_selection(compact=False):
+    """
+    将 st.session_state["selected"] 写入共享状态的 corrected，并追加到 progress.jsonl。
+    compact=True 或日志过大时，把完整进度合并写入 progress.csv。
+    """
+    state = get_state()
     idx = st.session_state["current_index"]
-    if "N/A" in st.session_state["selected_list"]:
+    if "N/A" in st.session_state["selected"]:
         new_corrected_str = "N/A"
-    # elif not st.session_state["selected_list"]:
-    #     new_corrected_str = df_progress.at[idx, "校对前"]
+    # elif not st.session_state["selected"]:
+    #     new_corrected_str = state["pre"][idx]
     else:
-        new_corrected_str = " ".join(st.session_state["selected_list"])
-    df_progress.at[idx, "校对后"] = new_corrected_str
-    save_progress(df_progress)
+        new_corrected_str = st.session_state["selected_str"]
+    if new_corrected_str != st.session_state["selected_str"]:
+        # 保存值与当前选择不一致（如含 N/A），下次加载需按保存值重建
+        st.session_state.pop("selected_for_idx", None)
+    with state["lock"]:
+        corrected = state["corrected"]
+        annotated_idx = state["annotated_idx"]
+        was_annotated = idx in corrected
+        if new_corrected_str:
+            if not was_annotated:
+                annotated_idx.append(idx)
+            corrected[idx] = new_corrected_str
+        elif was_annotated:
+            annotated_idx.remove(idx)
+            del corrected[idx]
+        state["edit_version"] += 1
+        journal_size = append_journal(state, idx, new_corrected_str)
+        if compact or journal_size > JOURNAL_COMPACT_BYTES:
+            close_journal(state)
+            save_progress(sync_corrected_column(state["df_progress"], corrected))
 
 # -----------------------
 # 主应用
 # -----------------------
+def jump_to_recent():
+    """
+    侧边栏下拉框的回调：先保存当前记录，再跳转到所选的已标注任务。
+    """
+    row_idx = st.session_state["sidebar_choice"]
+    if row_idx is None:
+        return
+    save_current_selection()
+    st.session_state["current_index"] = row_idx
+    load_current_selection()
+    st.session_state["sidebar_choice"] = None
+
+def sidebar_panel():
+    """
+    侧边栏：进度与最近已标注任务列表。选择条目会跳转到对应任务。
+    """
+    state = get_state()
+    origins = state["origins"]
+    with state["lock"]:
+        annotated_count = len(state["annotated_idx"])
+        recent_idx = list(islice(reversed(state["annotated_idx"]), SIDEBAR_LIMIT))
+        recent_corrected = {i: state["corrected"][i] for i in recent_idx}
+
+    total_count = len(origins)
+    st.subheader(f"已标注任务列表（最近{SIDEBAR_LIMIT}条）")
+    st.write(f"**进度**: 已校对 {annotated_count}/{total_count} 条")
+    st.write("---")
+
+    if not recent_idx:
+        st.write("目前还没有已校对的任务。")
+    else:
+        st.selectbox(
+            "最近标注",
+            options=recent_idx,
+            format_func=lambda i: f"{origins[i]} | {recent_corrected[i]}",
+            index=None,
+            placeholder="选择任务以跳转",
+            key="sidebar_choice",
+            on_change=jump_to_recent,
+        )
+
+@st.fragment
+def candidate_panel(idx, origin_word, pre_word, candidates):
+    """
+    当前记录的「校对后」与候选项勾选框。勾选/取消通过回调修改 selected，只重跑本片段，
+    不重建侧边栏和下载数据。
+    """
+    selected = st.session_state["selected"]
+
+    col_name, col_value = st.columns([1, 4])
+    with col_name:
+        st.write("**原形**")
+        st.write("**校对前**")
+        st.write("**校对后**")
+    with col_value:
+        st.write(origin_word)
+        st.write(pre_word)
+        if selected:
+            st.write(st.session_state["selected_str"])
+        else:
+            st.write("暂无")
+
+    st.write("---")
+    st.write("**候选项**:")
+
+    # 勾选框按 key 识别，value= 只在首次创建时生效；每次渲染前按 selected 重写，
+    # 保证在同一行重建选择后（如含 N/A 的保存）勾选状态仍与 selected 一致
+    for i, (c, freq) in enumerate(candidates):
+        key = f"cb_{idx}_{i}"
+        st.session_state[key] = c in selected
+        st.checkbox(f"{c} : {freq}", key=key, on_change=toggle_candidate, args=(c,))
+
+    st.session_state[f"cb_{idx}_na"] = "N/A" in selected
+    st.checkbox("原形不是词", key=f"cb_{idx}_na", on_change=toggle_candidate, args=("N/A",))
+
 def main():
     st.set_page_config(page_title="繁简转换校对平台")
     st.title("繁简转换校对平台")
 
 
     # 1. 读取/初始化 progress 数据
-    if "df_progress" not in st.session_state:
-        df_progress = load_progress()
-        st.session_state["df_progress"] = df_progress.copy()
-
-        df_unannotated = st.session_state["df_progress"][
-        st.session_state["df_progress"]["校对后"].isna() |
-        (st.session_state["df_progress"]["校对后"] == "")
-        ]
-        if not df_unannotated.empty:
-            st.session_state["current_index"] = df_unannotated.index[0]
+    state = get_state()
+    if not state["ready"].wait(LOAD_WAIT_SECONDS):
+        st.progress(state["loaded_fraction"], text=f"正在加载任务数据：已读取 {state['loaded_rows']} 行")
+        time.sleep(0.5)
+        st.rerun()
+    if state["load_error"] is not None:
+        # 清掉失败的共享状态，修复文件后刷新页面即可重新加载
+        get_state.clear()
+        st.error(str(state["load_error"]))
+        st.stop()
+    df_progress = state["df_progress"]
+    if "current_index" not in st.session_state:
+        # 定位第一条未标注记录：「校对后」列在运行期间不再更新，
+        # 因此按 corrected 的键生成掩码，且不构造过滤后的 DataFrame
+        with state["lock"]:
+            unannotated = ~df_progress.index.isin(list(state["corrected"]))
+        if unannotated.any():
+            st.session_state["current_index"] = int(df_progress.index[unannotated.argmax()])
         else:
             st.session_state["current_index"] = 0
 
-    df_progress = st.session_state["df_progress"]
+    total_count = len(df_progress)
 
     # 2. 侧边栏展示已标注列表
-    df_annotated_total = df_progress[df_progress["校对后"].notna() & (df_progress["校对后"] != "")]
-    # df_annotated = df_annotated.iloc[::-1].iloc[:500].reset_index(drop=True)
-    df_annotated = df_annotated_total.iloc[::-1].iloc[:500].reset_index(drop=False)
-
-    total_count = len(df_progress)
-    annotated_count = len(df_annotated)
-    st.sidebar.subheader("已标注任务列表（最近500条）")
-    st.sidebar.write(f"**进度**: 已校对 {annotated_count}/{total_count} 条")
-    st.sidebar.write("---")
+    with st.sidebar:
+        sidebar_panel()
 
-    if df_annotated.empty:
-        st.sidebar.write("目前还没有已校对的任务。")
-    else:
-        for i, row in df_annotated.iterrows():
-            origin_word = row["原形"]
-            corrected = row["校对后"]
-            if st.sidebar.button(f"{origin_word} | {corrected}", key=f"sidebar_{i}"):
-                # 翻页前先保存当前记录
-                save_current_selection()
-                st.session_state["current_index"] = row["index"]
-                load_current_selection()
-                st.rerun()
-
-
-    # 3. 初始化 current_index
-    if "current_index" not in st.session_state:
-        st.session_state["current_index"] = 0
 
-    # 防越界
+    # 3. 防越界
     if not (0 <= st.session_state["current_index"] < total_count):
         st.session_state["current_index"] = 0
 
-    # 4. 初始化 selected_list
-    if "selected_list" not in st.session_state:
+    # 4. 初始化 selected
+    if "selected" not in st.session_state:
         load_current_selection()
 
     # 5. 当前记录
     idx = st.session_state["current_index"]
-    current_row = df_progress.loc[idx]
-    origin_word = current_row["原形"]
-    pre_word = current_row["校对前"]
-    candidate_str = current_row["候选项"]
-    candidates = parse_candidates(candidate_str)
-    selected_list = st.session_state["selected_list"]
+    origin_word = state["origins"][idx]
+    pre_word = state["pre"][idx]
+    candidates = get_candidates(state, idx)
 
     st.subheader("任务详情")
     st.markdown(f"**{idx + 1} / {total_count}**")
-    col_name, col_value = st.columns([1, 4])
-    with col_name:
-        st.write("**原形**")
-        st.write("**校对前**")
-        st.write("**校对后**")
-    with col_value:
-        st.write(origin_word)
-        st.write(pre_word)
-        if selected_list:
-            st.write(" ".join(selected_list))
-        else:
-            st.write("暂无")
-
-    st.write("---")
-    st.write("**候选项**:")
-
-    for (c, freq) in sorted(candidates, key=lambda x: -int(x[1])):
-        col_op, col_info = st.columns([1, 4])
-        with col_op:
-            if c in selected_list:
-                if st.button("取消", key=f"cancel_{c}", type="primary"):
-                    selected_list.remove(c)
-                    st.rerun()
-            else:
-                if st.button("选择", key=f"select_{c}"):
-                    selected_list.append(c)
-                    st.rerun()
-        with col_info:
-            st.write(f"{c} : {freq}")
-
-    col_op, col_info = st.columns([1, 4])
-    with col_op:
-        if "N/A" in selected_list:
-            if st.button("取消", key="cancel_na", type="primary"):
-                selected_list.remove("N/A")
-                st.rerun()
-        else:
-            if st.button("选择", key="select_na"):
-                selected_list.append("N/A")
-                st.rerun()
-    with col_info:
-        st.write("原形不是词")
+    candidate_panel(idx, origin_word, pre_word, candidates)
 
     # 6. 导航、暂存、完成
     st.write("---")
@@ -238,14 +454,13 @@ def main():
     # 暂存：只保存进度到 progress.csv
     with col3:
         if st.button("暂存"):
-            save_current_selection()
+            save_current_selection(compact=True)
             st.success("已暂存当前标注结果。")
 
     with col4:
-        csv_data = st.session_state["df_progress"].to_csv(index=False, encoding="utf-8")
         st.download_button(
             label="下载",
-            data=csv_data,
+            data=progress_csv_exporter(),
             file_name="标注结果.csv",
             mime="text/csv"
         )